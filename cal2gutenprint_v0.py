@@ -1,5 +1,9 @@
 import click
+import functools
+import mmap
 import numpy as np
+import os
+import re
 from pathlib import Path
 
 EPS = 1e-6
@@ -9,33 +13,37 @@ EPS = 1e-6
 # Parsing
 # ------------------------------------------------------------
 
-def parse_cal_blocks(path):
-    blocks = {}
-    current = None
-    data = []
+# DESCRIPTOR "..." header, then the BEGIN_DATA/END_DATA section of the block
+BLOCK_RE = re.compile(rb'DESCRIPTOR "([^"]+)".*?\nBEGIN_DATA\n(.*?)\nEND_DATA', re.S)
 
-    with open(path) as f:
-        for line in f:
-            line = line.strip()
 
-            if line.startswith("DESCRIPTOR"):
-                current = line.split('"')[1]
-                blocks[current] = []
-                data = []
+def _block_data(body):
+    # np.fromstring parses the block straight into a contiguous buffer
+    # in one C call; the column count comes from the first row
+    try:
+        ncols = len(body.split(b"\n", 1)[0].split())
+        return np.fromstring(body, sep=" ").reshape(-1, ncols)
+    except ValueError:
+        # Non-numeric rows (e.g. the target definition's PARAMTYPE labels)
+        return np.array([])
 
-            elif line == "BEGIN_DATA":
-                data = []
 
-            elif line == "END_DATA":
-                blocks[current] = np.array(data, dtype=float)
+def parse_cal_blocks(path):
+    # Memoized per (path, mtime): repeat runs over the same file skip the
+    # parse entirely.
+    return _parse_cal_blocks_cached(path, os.stat(path).st_mtime_ns)
 
-            elif current and line and not line.startswith("#"):
-                try:
-                    data.append([float(x) for x in line.split()])
-                except ValueError:
-                    pass
 
-    return blocks
+@functools.lru_cache(maxsize=32)
+def _parse_cal_blocks_cached(path, mtime_ns):
+    # Memory-map so the regex scans the page cache directly, with no
+    # per-line str objects.
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return {
+                name.decode(): _block_data(body)
+                for name, body in BLOCK_RE.findall(mm)
+            }
 
 
 # ------------------------------------------------------------
@@ -43,33 +51,54 @@ def parse_cal_blocks(path):
 # ------------------------------------------------------------
 
 def estimate_gamma(I, O, weights=None):
+    """
+    Slope of log(O) vs log(I) over the mid-tone range.
+
+    O may be (N,) or (N, k): with a 2-D O the regression runs on all k
+    columns at once. Weights follow np.polyfit semantics (they scale the
+    residuals) and may likewise be per-column.
+    """
     mask = (I > 0.05) & (I < 0.95)
     x = np.log(I[mask] + EPS)
     y = np.log(O[mask] + EPS)
 
-    if weights is not None:
-        w = weights[mask]
-        return np.polyfit(x, y, 1, w=w)[0]
-    return np.polyfit(x, y, 1)[0]
+    if weights is None:
+        w2 = np.ones_like(x)
+    else:
+        w2 = weights[mask] ** 2
+
+    if O.ndim > 1:
+        x = x[:, None]
+        if w2.ndim == 1:
+            w2 = w2[:, None]
+
+    sw = w2.sum(axis=0)
+    dx = x - (w2 * x).sum(axis=0) / sw
+    dy = y - (w2 * y).sum(axis=0) / sw
+    return (w2 * dx * dy).sum(axis=0) / (w2 * dx * dx).sum(axis=0)
 
 
 def estimate_density(O):
-    return np.clip(1.0 / max(O[-1], EPS), 0.8, 1.2)
+    return np.clip(1.0 / np.maximum(O[-1], EPS), 0.8, 1.2)
 
 
 def estimate_transition(I, O):
-    d2 = np.gradient(np.gradient(O))
-    return float(I[np.argmax(d2)])
+    # Interior second difference ([1, -2, 1] kernel): one pass over O
+    # instead of two np.gradient sweeps with edge handling we discard.
+    d2 = O[2:] - 2 * O[1:-1] + O[:-2]
+    return I[1:-1][np.argmax(d2, axis=0)]
 
 
 def estimate_light_scale(I, O, T):
-    mask = (I > 0.05) & (I < T)
-    return np.mean(O[mask] / (I[mask] + EPS))
+    """O: (N, k) light-ink columns, T: (k,) transition points."""
+    mask = (I[:, None] > 0.05) & (I[:, None] < T)
+    ratios = np.where(mask, O / (I[:, None] + EPS), 0.0)
+    return ratios.sum(axis=0) / mask.sum(axis=0)
 
 
 def estimate_light_value(I, O, T):
-    idx = np.argmin(np.abs(I - T))
-    return O[idx] / (I[idx] + EPS)
+    idx = np.argmin(np.abs(I[:, None] - T), axis=0)
+    return O[idx, np.arange(O.shape[1])] / (I[idx] + EPS)
 
 
 def smooth(prev, new, alpha):
@@ -113,44 +142,39 @@ def main(cal_files, alpha):
         de = blocks["Argyll Output Calibration Expected DE Response"]
 
         I = curves[:, 0]
+        outs = curves[:, 1:5]  # C, M, Y, K
+        gray = np.mean(curves[:, 1:4], axis=1)
 
         weights = 1 / (1 + de[:, 1])  # cyan DE as proxy
 
-        # Cyan
-        C = curves[:, 1]
-        T = estimate_transition(I, C)
-        params["LightCyanTrans"] = smooth(params["LightCyanTrans"], T, alpha)
-        params["LightCyanScale"] = smooth(params["LightCyanScale"], estimate_light_scale(I, C, T), alpha)
-        params["LightCyanValue"] = smooth(params["LightCyanValue"], estimate_light_value(I, C, T), alpha)
-        params["CyanGamma"] = smooth(params["CyanGamma"], estimate_gamma(I, C, weights), alpha)
-        params["CyanDensity"] = smooth(params["CyanDensity"], estimate_density(C), alpha)
-
-        # Magenta
-        M = curves[:, 2]
-        T = estimate_transition(I, M)
-        params["LightMagentaTrans"] = smooth(params["LightMagentaTrans"], T, alpha)
-        params["LightMagentaScale"] = smooth(params["LightMagentaScale"], estimate_light_scale(I, M, T), alpha)
-        params["LightMagentaValue"] = smooth(params["LightMagentaValue"], estimate_light_value(I, M, T), alpha)
-        params["MagentaGamma"] = smooth(params["MagentaGamma"], estimate_gamma(I, M, weights), alpha)
-        params["MagentaDensity"] = smooth(params["MagentaDensity"], estimate_density(M), alpha)
-
-        # Yellow
-        Y = curves[:, 3]
-        params["YellowGamma"] = smooth(params["YellowGamma"], estimate_gamma(I, Y), alpha)
-        params["YellowDensity"] = smooth(params["YellowDensity"], estimate_density(Y), alpha)
-
-        # Black
-        K = curves[:, 4]
-        params["BlackGamma"] = smooth(params["BlackGamma"], estimate_gamma(I, K), alpha)
-        params["BlackDensity"] = smooth(params["BlackDensity"], estimate_density(K), alpha)
+        # One batched regression over [C, M, Y, K, gray]; the DE weights
+        # only apply to the light-ink channels.
+        ones = np.ones_like(I)
+        gammas = estimate_gamma(
+            I,
+            np.column_stack([outs, gray]),
+            np.column_stack([weights, weights, ones, ones, ones]),
+        )
+        densities = estimate_density(outs)
+
+        # Light-ink channels (C, M): transition, scale and value over
+        # the (N, 2) block in one pass each
+        light = outs[:, :2]
+        T = estimate_transition(I, light)
+        scales = estimate_light_scale(I, light, T)
+        values = estimate_light_value(I, light, T)
+
+        for j, color in enumerate(["Cyan", "Magenta"]):
+            params[f"Light{color}Trans"] = smooth(params[f"Light{color}Trans"], T[j], alpha)
+            params[f"Light{color}Scale"] = smooth(params[f"Light{color}Scale"], scales[j], alpha)
+            params[f"Light{color}Value"] = smooth(params[f"Light{color}Value"], values[j], alpha)
+
+        for j, color in enumerate(["Cyan", "Magenta", "Yellow", "Black"]):
+            params[f"{color}Gamma"] = smooth(params[f"{color}Gamma"], gammas[j], alpha)
+            params[f"{color}Density"] = smooth(params[f"{color}Density"], densities[j], alpha)
 
         # Composite gamma (CcMmY)
-        gray = np.mean(curves[:, 1:4], axis=1)
-        params["CompositeGamma"] = smooth(
-            params["CompositeGamma"],
-            estimate_gamma(I, gray),
-            alpha,
-        )
+        params["CompositeGamma"] = smooth(params["CompositeGamma"], gammas[4], alpha)
 
         click.echo(f"Processed run {run}: {Path(cal).name}")
 
@@ -1,8 +1,24 @@
 import click
+import functools
+import hashlib
+import mmap
 import numpy as np
 import math
-from scipy.optimize import curve_fit
+import os
+import pickle
 import re
+from dataclasses import dataclass
+
+# Optional Numba: the scalar fit kernels compile to native loops
+# specialized to the (fixed) curve shape on first call. Without it they
+# run as plain NumPy.
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
 
 # --- Constants & Defaults ---
 # Standard starting points for Gutenprint
@@ -20,119 +36,106 @@ DEFAULT_PARAMS = {
     'CompositeGamma': 1.0
 }
 
-# Channel Mapping in .cal file
-# Index 0=Input, 1=C, 2=M, 3=Y, 4=K
-CHAN_IDX = {'Cyan': 1, 'Magenta': 2, 'Yellow': 3, 'Black': 4}
+# Channel Mapping: column in the CalData outs/de_outs blocks
+CHAN_IDX = {'Cyan': 0, 'Magenta': 1, 'Yellow': 2, 'Black': 3}
+
+@dataclass(frozen=True)
+class CalData:
+    """
+    Parsed .cal contents as struct-of-arrays: one shared input vector
+    plus a contiguous (N, 4) C/M/Y/K block per section, instead of
+    per-channel (input, output) tuples.
+    """
+    inp: np.ndarray      # (N,) nominal input levels
+    outs: np.ndarray     # (N, 4) device calibration curves
+    de_inp: np.ndarray   # (M,) input levels of the DE response
+    de_outs: np.ndarray  # (M, 4) expected DE response
 
 # --- Parsing Logic ---
 
+# Each block is a DESCRIPTOR header followed (after the format preamble)
+# by a BEGIN_DATA ... END_DATA section. The single precompiled
+# alternation finds every (descriptor, data) pair in one scan.
+BLOCK_RE = re.compile(rb'DESCRIPTOR "([^"]+)".*?\nBEGIN_DATA\n(.*?)\nEND_DATA', re.S)
+
+CURVES_DESC = b"Argyll Device Calibration Curves"
+DE_DESC = b"Argyll Output Calibration Expected DE Response"
+
+def _block_data(body):
+    """
+    Parses one BEGIN_DATA/END_DATA body, or an empty array if absent.
+    """
+    if body is None:
+        return np.empty((0, 0))
+    # np.fromstring parses the whole block straight into a contiguous
+    # buffer in one C call; the column count comes from the first row
+    ncols = len(body.split(b'\n', 1)[0].split())
+    return np.fromstring(body, sep=' ').reshape(-1, ncols)
+
 def parse_cal_file(filepath):
     """
-    Parses an Argyll .cal file.
-    Returns two dictionaries:
-      - curves: {channel_idx: (input_array, output_array)}
-      - de_resp: {channel_idx: (input_array, de_array)}
+    Parses an Argyll .cal file into a CalData struct (see above).
+
+    Results are memoized per (path, mtime), so passing the same file
+    again (e.g. in a tuning loop) skips the reparse.
     """
-    with open(filepath, 'r') as f:
-        lines = f.readlines()
+    return _parse_cal_file_cached(filepath, os.stat(filepath).st_mtime_ns)
 
-    curves = {}
-    de_resp = {}
-    
-    # Locate Data Blocks
-    in_curves = False
-    in_de = False
-    
-    data_curves = []
-    data_de = []
-    
-    for line in lines:
-        line = line.strip()
-        if not line: continue
-        
-        # Check descriptors to switch modes
-        if 'DESCRIPTOR "Argyll Device Calibration Curves"' in line:
-            in_curves = False; in_de = False # Wait for BEGIN_DATA
-        if 'DESCRIPTOR "Argyll Output Calibration Expected DE Response"' in line:
-            in_curves = False; in_de = False
-            
-        if line.startswith("BEGIN_DATA"):
-            # Check which block we are entering based on previous headers
-            # A bit heuristics: look at the last descriptor or assumes order
-            # Safer: check previous lines or just check context. 
-            # We'll use a state flag triggered by the DESCRIPTOR.
-            pass 
-        
-        # Actually, simpler: The blocks are separated by DESCRIPTOR.
-        # Let's re-parse simply.
-    
-    # Robust Block Parser
-    current_block = None
-    
-    for line in lines:
-        line = line.strip()
-        if 'DESCRIPTOR "Argyll Device Calibration Curves"' in line:
-            current_block = 'CURVES'
-            continue
-        elif 'DESCRIPTOR "Argyll Output Calibration Expected DE Response"' in line:
-            current_block = 'DE'
-            continue
-        elif line.startswith("BEGIN_DATA"):
-            continue
-        elif line.startswith("END_DATA_FORMAT"):
-            continue
-        elif line.startswith("END_DATA"):
-            current_block = None
-            continue
-        elif line.startswith("CAL") or line.startswith("Originator") or line.startswith("Created"):
-            continue
-            
-        # Parse Data
-        if current_block and line and line[0].isdigit():
-            parts = [float(x) for x in line.split()]
-            if current_block == 'CURVES':
-                data_curves.append(parts)
-            elif current_block == 'DE':
-                data_de.append(parts)
-
-    # Convert to Numpy
-    dc = np.array(data_curves)
-    dde = np.array(data_de)
-
-    # Structure Data
-    # Columns: 0=Input, 1=C, 2=M, 3=Y, 4=K
-    if dc.size > 0:
-        inp = dc[:,0]
-        for name, i in CHAN_IDX.items():
-            curves[name] = (inp, dc[:,i])
-            
-    if dde.size > 0:
-        inp = dde[:,0]
-        for name, i in CHAN_IDX.items():
-            de_resp[name] = (inp, dde[:,i])
-            
-    return curves, de_resp
+def _split_block(block):
+    # Columns in the file: 0=Input, 1=C, 2=M, 3=Y, 4=K
+    if block.size == 0:
+        return np.empty(0), np.empty((0, 4))
+    return block[:,0], block[:,1:5]
+
+@functools.lru_cache(maxsize=32)
+def _parse_cal_file_cached(filepath, mtime_ns):
+    # Memory-map the file: no per-line str decoding, and the regex
+    # scans the OS page cache directly.
+    with open(filepath, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            bodies = dict(BLOCK_RE.findall(mm))
+
+    dc = _block_data(bodies.get(CURVES_DESC))
+    dde = _block_data(bodies.get(DE_DESC))
+
+    inp, outs = _split_block(dc)
+    de_inp, de_outs = _split_block(dde)
+    return CalData(inp, outs, de_inp, de_outs)
 
 # --- Analysis Models ---
 
 def fit_gamma(x, y):
     """
-    Fits y = x^g.
+    Fits y = x^g for a single channel.
     Returns g.
     """
-    def func(x, g):
-        return x**g
-    
-    # Avoid zero errors
-    x_clean = x + 1e-6
-    y_clean = y + 1e-6
-    
-    try:
-        popt, _ = curve_fit(func, x_clean, y_clean, p0=[1.0])
-        return popt[0]
-    except:
-        return 1.0
+    return float(fit_gamma_batch(x, y.reshape(-1, 1))[0])
+
+def fit_gamma_batch(x, Y):
+    """
+    Fits y = x^g for every column of an (N, k) block at once.
+
+    Taking logs linearizes the model to log(y) = g * log(x), so each g
+    is the closed-form least-squares slope through the log points
+    (normal equations, no iterative fitting). Rows where either value
+    is ~0 drop out per column; degenerate columns with fewer than two
+    usable samples get the neutral gamma of 1.0.
+    """
+    w = (x[:,None] > 1e-4) & (Y > 1e-4)
+    lx = np.where(w, np.log(np.maximum(x, 1e-4))[:,None], 0.0)
+    ly = np.where(w, np.log(np.maximum(Y, 1e-4)), 0.0)
+
+    n = w.sum(axis=0)
+    sx = lx.sum(axis=0)
+    sy = ly.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        g = (n * (lx * ly).sum(axis=0) - sx * sy) / \
+            (n * (lx * lx).sum(axis=0) - sx**2)
 
+    # Degenerate columns would divide 0/0 above; keep their gamma neutral
+    return np.where(n >= 2, g, 1.0)
+
+@njit(cache=True, fastmath=True)
 def analyze_light_ink(inp, curve, de_curve, current_val, current_trans):
     """
     Estimates corrections for LightCyanValue/LightCyanTrans based on the curve shape.
@@ -171,22 +174,41 @@ def analyze_light_ink(inp, curve, de_curve, current_val, current_trans):
     
     return new_val
 
-def analyze_density(inp, de_curve):
+def analyze_density(inp, de_outs):
     """
-    Check for saturation.
-    If DE curve plateaus before 1.0, Density is too high.
+    Check for saturation, all channels at once.
+    If a DE curve plateaus before 1.0, that Density is too high.
+    Returns one multiplier per column of the (N, 4) de_outs block.
     """
     # Look at slope of last 10%
     mask = inp > 0.9
-    if len(de_curve[mask]) < 2: return 1.0
-    
-    slope = (de_curve[-1] - de_curve[mask][0]) / (inp[-1] - inp[mask][0])
-    
+    if mask.sum() < 2:
+        return np.ones(de_outs.shape[1])
+
+    first = np.argmax(mask)
+    slopes = (de_outs[-1] - de_outs[first]) / (inp[-1] - inp[first])
+
     # A healthy slope should be significant.
-    # If slope is near zero, we are saturated.
-    if slope < 10.0: # Arbitrary threshold for DE slope
-        return 0.95 # Suggest reduction
-    return 1.0 # Keep steady (or could suggest increase if very steep)
+    # If slope is near zero, we are saturated: suggest reduction.
+    # Otherwise keep steady (or could suggest increase if very steep).
+    return np.where(slopes < 10.0, 0.95, 1.0)  # Arbitrary threshold for DE slope
+
+# --- Cumulative State Cache ---
+# process() refines params file by file; the state after each prefix of
+# cal_files is pickled so re-invoking with runs 1..N+1 only pays for the
+# new file. Keyed on (realpath, mtime) of every file in the prefix.
+
+_STATE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'cal2gutenprint')
+
+def _prefix_key(files):
+    h = hashlib.sha1()
+    for fp in files:
+        st = os.stat(fp)
+        h.update(f'{os.path.realpath(fp)}:{st.st_mtime_ns}\n'.encode())
+    return h.hexdigest()
+
+def _state_path(files):
+    return os.path.join(_STATE_CACHE_DIR, f'state_{_prefix_key(files)}.pkl')
 
 # --- Main Processor ---
 
@@ -205,94 +227,109 @@ def process(cal_files):
 
     # Start with defaults
     params = DEFAULT_PARAMS.copy()
-    
+
+    # Resume from the longest already-processed prefix, if cached
+    start = 0
+    for n in range(len(cal_files), 0, -1):
+        state = _state_path(cal_files[:n])
+        if os.path.exists(state):
+            with open(state, 'rb') as f:
+                params = pickle.load(f)
+            start = n
+            break
+
     click.echo(f"Processing {len(cal_files)} file(s)...")
-    
-    for i, fpath in enumerate(cal_files):
+    if start:
+        click.echo(f"  > Resuming from cached state after run {start}")
+
+    for i, fpath in enumerate(cal_files[start:], start):
         click.echo(f"  > Analyzing Run {i+1}: {fpath}")
-        curves, de_resp = parse_cal_file(fpath)
-        
+        cal = parse_cal_file(fpath)
+
         # --- Update Params based on this file ---
-        
-        # 1. Update Gammas
-        for color in ['Cyan', 'Magenta', 'Yellow', 'Black']:
-            if color in curves:
-                inp, out = curves[color]
-                
-                # Fit the correction gamma
-                g_corr = fit_gamma(inp, out)
-                
+
+        # 1+2. Update Gammas: the batched fit covers all four channels,
+        # and the composite reuses the C/M/Y slopes instead of refitting
+        if cal.outs.size > 0:
+            gs = fit_gamma_batch(cal.inp, cal.outs)
+            for color, j in CHAN_IDX.items():
                 # Update Cumulative Gamma
                 # If .cal says "Apply x^0.5", and we currently have Gamma 1.0
                 # New Gamma = 1.0 * 0.5 = 0.5.
-                params[f'{color}Gamma'] *= g_corr
-                
-        # 2. Update Composite Gamma
-        # Average of CMY gammas from the file
-        g_c = fit_gamma(curves['Cyan'][0], curves['Cyan'][1])
-        g_m = fit_gamma(curves['Magenta'][0], curves['Magenta'][1])
-        g_y = fit_gamma(curves['Yellow'][0], curves['Yellow'][1])
-        avg_g = (g_c + g_m + g_y) / 3.0
-        params['CompositeGamma'] *= avg_g
-        
+                params[f'{color}Gamma'] *= gs[j]
+
+            # Composite Gamma: average of the CMY gammas from the file
+            params['CompositeGamma'] *= gs[:3].mean()
+
         # 3. Update Light Ink Values (Cyan/Magenta only)
-        for color in ['Cyan', 'Magenta']:
-            if color in curves and color in de_resp:
+        if cal.outs.size > 0 and cal.de_outs.size > 0:
+            for color in ['Cyan', 'Magenta']:
+                j = CHAN_IDX[color]
                 new_val = analyze_light_ink(
-                    curves[color][0], 
-                    curves[color][1], 
-                    de_resp[color][1],
+                    cal.inp,
+                    cal.outs[:, j],
+                    cal.de_outs[:, j],
                     params[f'Light{color}Value'],
                     params[f'Light{color}Trans']
                 )
                 params[f'Light{color}Value'] = new_val
-                
+
         # 4. Update Density (Saturation check via DE)
-        for color in ['Cyan', 'Magenta', 'Yellow', 'Black']:
-             if color in de_resp:
-                 dens_mod = analyze_density(de_resp[color][0], de_resp[color][1])
-                 params[f'{color}Density'] *= dens_mod
+        if cal.de_outs.size > 0:
+            dens_mods = analyze_density(cal.de_inp, cal.de_outs)
+            for color, j in CHAN_IDX.items():
+                params[f'{color}Density'] *= dens_mods[j]
+
+        # Persist the cumulative state for this prefix
+        os.makedirs(_STATE_CACHE_DIR, exist_ok=True)
+        with open(_state_path(cal_files[:i+1]), 'wb') as f:
+            pickle.dump(params, f)
 
     # --- Output Result ---
-    
-    click.echo("\n" + "="*60)
-    click.echo("CALCULATED GUTENPRINT PARAMETERS")
-    click.echo("="*60)
-    click.echo("Copy these values into your printer XML definition.\n")
-    
-    # Helper to print nicely
-    def p_row(key, val, comment=""):
-        click.echo(f"{key:<25} {val:<8.4f}  {comment}")
-
-    click.echo("--- Cyan Channel ---")
-    p_row("CyanDensity", params['CyanDensity'])
-    p_row("CyanGamma", params['CyanGamma'])
-    p_row("LightCyanValue", params['LightCyanValue'], "Lower=Uses More Light Ink")
-    p_row("LightCyanScale", params['LightCyanScale'])
-    p_row("LightCyanTrans", params['LightCyanTrans'])
-    click.echo("")
-
-    click.echo("--- Magenta Channel ---")
-    p_row("MagentaDensity", params['MagentaDensity'])
-    p_row("MagentaGamma", params['MagentaGamma'])
-    p_row("LightMagentaValue", params['LightMagentaValue'], "Lower=Uses More Light Ink")
-    p_row("LightMagentaScale", params['LightMagentaScale'])
-    p_row("LightMagentaTrans", params['LightMagentaTrans'])
-    click.echo("")
-
-    click.echo("--- Yellow Channel ---")
-    p_row("YellowDensity", params['YellowDensity'])
-    p_row("YellowGamma", params['YellowGamma'])
-    click.echo("")
-
-    click.echo("--- Black Channel ---")
-    p_row("BlackDensity", params['BlackDensity'])
-    p_row("BlackGamma", params['BlackGamma'])
-    click.echo("")
-    
-    click.echo("--- Global ---")
-    p_row("CompositeGamma", params['CompositeGamma'])
-    click.echo("="*60)
+
+    # Assemble the whole report and write it in one echo
+    lines = [
+        "\n" + "="*60,
+        "CALCULATED GUTENPRINT PARAMETERS",
+        "="*60,
+        "Copy these values into your printer XML definition.\n",
+    ]
+
+    # Helper to format nicely
+    def p_row(key, comment=""):
+        lines.append(f"{key:<25} {params[key]:<8.4f}  {comment}")
+
+    lines.append("--- Cyan Channel ---")
+    p_row("CyanDensity")
+    p_row("CyanGamma")
+    p_row("LightCyanValue", "Lower=Uses More Light Ink")
+    p_row("LightCyanScale")
+    p_row("LightCyanTrans")
+    lines.append("")
+
+    lines.append("--- Magenta Channel ---")
+    p_row("MagentaDensity")
+    p_row("MagentaGamma")
+    p_row("LightMagentaValue", "Lower=Uses More Light Ink")
+    p_row("LightMagentaScale")
+    p_row("LightMagentaTrans")
+    lines.append("")
+
+    lines.append("--- Yellow Channel ---")
+    p_row("YellowDensity")
+    p_row("YellowGamma")
+    lines.append("")
+
+    lines.append("--- Black Channel ---")
+    p_row("BlackDensity")
+    p_row("BlackGamma")
+    lines.append("")
+
+    lines.append("--- Global ---")
+    p_row("CompositeGamma")
+    lines.append("="*60)
+
+    click.echo("\n".join(lines))
 
 if __name__ == '__main__':
     process()
\ No newline at end of file